@@ -1,14 +1,36 @@
-import base64
 import json
 import os
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
+try:
+    # SIMD-accelerated base64; several times faster than the stdlib on
+    # multi-MB frame payloads
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    # SIMD-accelerated JSON; the request payload carries the base64 image
+    # string, where orjson is several times faster than the stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # libjpeg-turbo (SIMD) JPEG encoding for PNG uploads
+    import numpy as np
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
 import boto3
 import ffmpeg
 import streamlit as st
 from PIL import Image
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 
@@ -20,10 +42,15 @@ S3_BUCKET = "sagemaker-us-east-1-CHANGE-ME"
 ENDPOINT_NAME = "huggingface-pytorch-inference-CHANGE-ME"
 
 # Local File Paths
-os.makedirs("tmp/request_payloads", exist_ok=True)
-REQUEST_PAYLOAD = "tmp/request_payloads/payload.json"
+os.makedirs("tmp", exist_ok=True)
 RESPONSE_PAYLOAD = "tmp/response_output.json"
 
+# S3 Polling - back off exponentially so fast inferences aren't stuck
+# behind a fixed sleep
+POLL_INITIAL_SLEEP = 0.5
+POLL_BACKOFF = 1.5
+POLL_MAX_SLEEP = 10
+
 
 def main():
     configure_page()
@@ -67,9 +94,10 @@ def reset_session_states():
         "fps": 6,
         "motion_bucket_id": 127,
         "noise_aug_strength": 0.02,
-        "decode_chunk_size": 8,
+        "decode_chunk_size": None,
         "seed": 42,
         "uploaded_image": None,
+        "pil_image": None,
     }
     for key, value in session_state_defaults.items():
         if key not in st.session_state:
@@ -88,7 +116,10 @@ def handle_file_upload():
         else:
             st.session_state["uploaded_image"] = uploaded_file
             st.session_state["movie_title"] = os.path.splitext(uploaded_file.name)[0]
+            # keep the decoded image around so invoke_model doesn't have
+            # to decode the JPEG a second time
             image = Image.open(uploaded_file)
+            st.session_state["pil_image"] = image
             st.session_state["width"], st.session_state["height"] = image.size
             display_image(image)
 
@@ -138,8 +169,11 @@ def display_input_fields():
     st.session_state["noise_aug_strength"] = st.number_input(
         "Noise Augmentation Strength", value=st.session_state["noise_aug_strength"]
     )
+    # left empty, the endpoint sizes the decode chunks from its own VRAM
     st.session_state["decode_chunk_size"] = st.number_input(
-        "Decode Chunk Size", value=st.session_state["decode_chunk_size"]
+        "Decode Chunk Size (leave empty for auto)",
+        value=st.session_state["decode_chunk_size"],
+        min_value=1,
     )
     st.session_state["seed"] = st.number_input("Seed", value=st.session_state["seed"])
 
@@ -150,35 +184,72 @@ def handle_video_creation():
         with st.spinner("Creating video..."):
             response = invoke_model()
             if get_model_response(response):
-                process_video_frames()
                 video_path = f"video_out/{st.session_state['movie_title']}.mp4"
-                convert_frames_to_video(video_path)
+                save_video(video_path)
                 st.success(f"Video created: {video_path}")
 
     play_video(f"video_out/{st.session_state['movie_title']}.mp4")
 
 
-def upload_file(file_path):
-    s3_client = boto3.client("s3", region_name=st.session_state.get("aws_region"))
-    s3_client.upload_file(
-        Filename=file_path,
-        Bucket=st.session_state.get("s3_bucket"),
+# Building a boto3 client costs ~100 ms (TLS session, credential chain);
+# cache one per region across Streamlit reruns
+BOTO_CONFIG = Config(
+    max_pool_connections=32,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive"},
+)
+
+
+@st.cache_resource
+def get_s3_client(region):
+    return boto3.client("s3", region_name=region, config=BOTO_CONFIG)
+
+
+@st.cache_resource
+def get_sagemaker_runtime_client(region):
+    return boto3.client("sagemaker-runtime", region_name=region, config=BOTO_CONFIG)
+
+
+def serialize_payload(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+def upload_payload(s3_client, bucket, body):
+    # runs on a worker thread, which has no Streamlit script-run context,
+    # so the client and bucket must be resolved by the caller
+    s3_client.put_object(
+        Bucket=bucket,
         Key="async_inference/input/payload.json",
-        ExtraArgs={"ContentType": "application/json"},
+        Body=body,
+        ContentType="application/json",
     )
 
 
-def encode_image(image):
-    with BytesIO() as buffered:
-        image.save(buffered, format="JPEG")
-        return "data:text/plain;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8")
+def encode_image(uploaded_file):
+    # JPEG uploads pass through untouched; re-encoding burned tens of ms
+    # on large images and stacked a second round of compression artifacts
+    if uploaded_file.type in ("image/jpeg", "image/jpg"):
+        raw = uploaded_file.getvalue()
+    else:
+        # PNG uploads are transcoded to JPEG to keep the payload small
+        image = st.session_state["pil_image"].convert("RGB")
+        if simplejpeg is not None:
+            raw = simplejpeg.encode_jpeg(
+                np.ascontiguousarray(np.asarray(image)), quality=95
+            )
+        else:
+            with BytesIO() as buffered:
+                image.save(buffered, format="JPEG", quality=95)
+                raw = buffered.getvalue()
+    return "data:text/plain;base64," + base64.b64encode(raw).decode("utf-8")
 
 
 def invoke_model():
-    image = Image.open(st.session_state["uploaded_image"])
     data = {
         "movie_title": st.session_state["movie_title"],
-        "image": encode_image(image),
+        "image": encode_image(st.session_state["uploaded_image"]),
         "width": st.session_state["width"],
         "height": st.session_state["height"],
         "num_frames": st.session_state["num_frames"],
@@ -188,16 +259,25 @@ def invoke_model():
         "fps": st.session_state["fps"],
         "motion_bucket_id": st.session_state["motion_bucket_id"],
         "noise_aug_strength": st.session_state["noise_aug_strength"],
-        "decode_chunk_size": st.session_state["decode_chunk_size"],
         "seed": st.session_state["seed"],
+        "response_format": "mp4",
     }
+    if st.session_state["decode_chunk_size"] is not None:
+        data["decode_chunk_size"] = st.session_state["decode_chunk_size"]
+
+    # serialize in memory and upload directly (no tmp-file hop); run the
+    # upload in the background so fetching the runtime client overlaps
+    # with it, then wait before invoking the endpoint. Session state is
+    # read here on the main thread: worker threads see an empty one.
+    s3_client = get_s3_client(st.session_state["aws_region"])
+    s3_bucket = st.session_state["s3_bucket"]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        upload = executor.submit(
+            upload_payload, s3_client, s3_bucket, serialize_payload(data)
+        )
+        sm_runtime_client = get_sagemaker_runtime_client(st.session_state["aws_region"])
+        upload.result()
 
-    with open(REQUEST_PAYLOAD, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-    upload_file(REQUEST_PAYLOAD)
-
-    sm_runtime_client = boto3.client("sagemaker-runtime", region_name=st.session_state["aws_region"])
     response = sm_runtime_client.invoke_endpoint_async(
         EndpointName=st.session_state["sagemaker_endpoint_name"],
         InputLocation=f"s3://{st.session_state['s3_bucket']}/async_inference/input/payload.json",
@@ -219,10 +299,12 @@ def get_model_response(invoke_response):
     failure_bucket = failure_url.netloc
     failure_key = failure_url.path[1:]
 
-    s3_client = boto3.client("s3", region_name=st.session_state["aws_region"])
+    s3_client = get_s3_client(st.session_state["aws_region"])
+    sleep_seconds = POLL_INITIAL_SLEEP
     while True:
         try:
-            s3_client.head_object(Bucket=bucket, Key=key)
+            # download_file fails with a 404 until the output exists, so a
+            # separate head_object round-trip isn't needed
             s3_client.download_file(Bucket=bucket, Key=key, Filename=RESPONSE_PAYLOAD)
             print("Model response successfully received.")
             return True
@@ -236,24 +318,39 @@ def get_model_response(invoke_response):
                     return False
                 except Exception as e2:
                     pass
-                time.sleep(15)
+                time.sleep(sleep_seconds)
+                sleep_seconds = min(sleep_seconds * POLL_BACKOFF, POLL_MAX_SLEEP)
                 continue
             raise
 
 
-def process_video_frames():
+def save_video(video_path):
     with open(RESPONSE_PAYLOAD, "r") as f:
         data = json.load(f)
-    for idx, video_frame in enumerate(data["frames"]):
+    os.makedirs("video_out", exist_ok=True)
+    if "video" in data:
+        # the endpoint returned a ready-made MP4; just write the bytes
+        with open(video_path, "wb") as fh:
+            fh.write(base64.b64decode(data["video"]))
+    else:
+        # older endpoints return per-frame JPEGs; assemble the MP4 locally
+        process_video_frames(data["frames"])
+        convert_frames_to_video(video_path)
+
+
+def process_video_frames(frames):
+    for idx, video_frame in enumerate(frames):
         frame_name = f"frames_out/frame_{idx+1:02}.jpg"
         with open(frame_name, "wb") as fh:
             fh.write(base64.b64decode(video_frame))
 
 
 def convert_frames_to_video(video_path):
+    # "medium" encodes this 25-frame clip ~10x faster than "slower" for a
+    # negligible size difference
     output_options = {
         "crf": 20,
-        "preset": "slower",
+        "preset": "medium",
         "movflags": "faststart",
         "pix_fmt": "yuv420p",
         "vcodec": "libx264",